@@ -26,6 +26,8 @@ R1+="([a-zA-Z0-9\s ]+)?,"
 R1+="([0-9.\-]+)?,"
 R1+="([0-9.\-]+)?";
 
+DEVSKIP="^( +)?#.*$|^$";
+
 
 DEVFILE="";
 DEVFILEPASS="";
@@ -35,6 +37,7 @@ VERB=0;
 SSHO=0;
 FORMAT="node_exporter"; 
 PDT=10;
+RTO="";
 PORT="/dev/ttyACM0";
 MODE="serial"
 ORPASS="";
@@ -45,7 +48,8 @@ MESHTASTIC="/usr/bin/meshtastic";
 TPUT="/usr/bin/tput"
 EXPECTAGR="-nN -f -";
 
-OPENSSL_OPT="-pbkdf2 -iter 1000 -aes-256-cbc -md SHA256";
+OPENSSL_OPT="-pbkdf2 -aes-256-cbc -md SHA256";
+PBKDF2_ITER=1000;
 
 GREPARGS="Battery|Voltage|utilization"
 
@@ -81,7 +85,16 @@ Options:
 
   -P <password>   Password for encrypted device file.
 
-  -t              Passive dwell time between polling each node.
+  -I <iterations> PBKDF2 iterations the device file was encrypted with.
+                  (default- $PBKDF2_ITER)
+
+  -t <seconds>    Passive dwell time between polling each node. Each
+                  node after the first adds this much to the run.
+                  (default- $PDT)
+
+  -T <seconds>    Give up on a node that has not answered after this long.
+                  Answers are used as soon as they arrive.
+                  (default- meshtastic CLI default)
 
   -v              Show verbose output/debug
 
@@ -95,12 +108,13 @@ __EOF__
 }
 
 
-while getopts "f:o:d:m:u:hip:P:t:lvL" opt; do
+while getopts "f:o:d:m:u:hiI:p:P:t:T:lvL" opt; do
 	case $opt in
 		f) DEVFILE="${OPTARG}";;
 		d) DLST="${OPTARG}";;
 		h) usage; exit 0 ;;
 		i) INDIV=1;;
+		I) PBKDF2_ITER="${OPTARG}";;
 		m) MODE="${OPTARG}";;
 		o) FORMAT="${OPTARG}";;
 		k) SSHO=1;;
@@ -108,10 +122,11 @@ while getopts "f:o:d:m:u:hip:P:t:lvL" opt; do
 		L) DOLS=2;;
 		p) PORT="${OPTARG}";;
 		t) PDT="${OPTARG}";;
+		T) RTO="${OPTARG}";;
 		u) CUSER="${OPTARG}";;
 		v) VERB=1;;
 
-		P) read -s -p "DEVFILE Password: " DEVFILEPASS;;
+		P) read -s -p "DEVFILE Password: " DEVFILEPASS; echo >&2;;
 		:) echo "Option -$OPTARG requires an argument." >&2;exit 1;;
 		\?) echo "Invalid option: -$OPTARG"; usage >&2;exit 1;;
 	esac;
@@ -144,9 +159,12 @@ function cursorBack() {
   echo -en "\033[$1D"
 }
 
+# Animate until the job feeding fd 3 writes its exit code or closes the
+# pipe, then return that exit code.
 function spinner() {
   local LC_CTYPE=C
-  local pid=$1
+  local rs delay=0.1
+  if [ "${BASH_VERSINFO[0]}" -lt 4 ]; then delay=1; fi # read -t takes whole seconds before bash 4
   case $(($RANDOM % 12)) in
   0)
     local spin='⠁⠂⠄⡀⢀⠠⠐⠈'
@@ -200,65 +218,79 @@ function spinner() {
 
   local i=0
   if [ -f "$TPUT" ]; then tput civis; fi
-	while kill -0 $pid 2>/dev/null; do
+	while :; do
     local i=$(((i + $charwidth) % ${#spin}))
   printf "%s" "${spin:$i:$charwidth}"
 
     cursorBack 1
-    sleep .1
+    read -t ${delay} rs <&3
+    if [ $? -le 128 ]; then break; fi
 	done
 	  if [ -f "$TPUT" ]; then tput cnorm; fi
-wait $pid # capture exit code
-return $?
+return ${rs:-1}
 }
 
 case "$TERM" in
     *dumb*) INTERACT=0;;
     *)      INTERACT=1;;
 esac;
+# The spinner draws on stderr, skip it when nobody is watching stderr.
+if [ ! -t 2 ]; then INTERACT=0; fi
 
 if [ ! -f $DEVFILE ]; then echo ${DEVFILE} " not found!"; exit 1; fi
 if  [ "$MODE" == "serial" ] && [ ! -c $PORT ]; then echo ${PORT} " port not found!"; exit 1; fi
 if [ ! -x $MESHTASTIC ]; then echo ${MESHTASTIC} " not found!"; exit 1; fi
+if [[ ! ${PBKDF2_ITER} =~ ^[1-9][0-9]*$ ]]; then echo "Invalid option: -I ${PBKDF2_ITER}"; usage >&2;exit 1; fi
+if [ ! -z "${RTO}" ] && [[ ! ${RTO} =~ ^[1-9][0-9]*$ ]]; then echo "Invalid option: -T ${RTO}"; usage >&2;exit 1; fi
+
+# True when $1 is a plain decimal number ([+-]digits[.digits]), matched
+# with case patterns so no regex is compiled per metric.
+function is_numeric() {
+	local v=${1#[+-]}
+	case $v in
+		''|.*|*[!0-9.]*|*.*.*) return 1;;
+	esac
+	return 0
+}
 
+# Format the KEYS/VALS pairs collected by poll_node as node_exporter lines.
 function promnode() {
+    local j KEY TELE PNEX_OUTPUT NLBL="node=\"${NODE}\""
 
-			arr=("$@")
-
-    for i in "${arr[@]}"
+    for (( j = 0; j < ${#KEYS[@]}; j++ ))
     do 
-    	if [ "${VERB}" -eq 1 ]; then
-    	echo $NODE " Raw variable:  " $i
-    	fi;
-
-    	TELE=( $( echo $i | cut -d : -f 1 | sed -e 's/ /_/g' | awk '{$1=$1};1' ) )
-    	TELE+=( $( echo $i | cut -d : -f 2 | sed -e 's/[Vv%]$//g' | awk '{$1=$1};1' ) )
+    	KEY=${KEYS[j]// /_}
+    	TELE=( "${KEY//$'\t'/}" "${VALS[j]}" )
 
     	if [ "${VERB}" -eq 1 ]; then
     	echo $NODE "Filtered array: "${TELE[@]}
     	fi;
 
-    		PNEX_INDEX=(meshtastic_"${TELE[0]}")
-    		if [[ ${TELE[1]} =~ ^[+-]?[0-9]+\.?[0-9]*$ ]]; then
-    		PNEX_OUTPUT=(""${PNEX_INDEX}"{node=\""$NODE"\"} "${TELE[1]}"")
+    		if is_numeric "${TELE[1]}"; then
+    		PNEX_OUTPUT="meshtastic_${TELE[0]}{${NLBL}} ${TELE[1]}"
     		else
-    		PNEX_OUTPUT=("${PNEX_INDEX}""{node=\""$NODE"\",str=\""${TELE[1]}"\"} 1")
+    		PNEX_OUTPUT="meshtastic_${TELE[0]}{${NLBL},str=\"${TELE[1]}\"} 1"
     		fi
-			if [ "${VERB}" -eq 1 ]; then echo "Node Exporter formated: "$PNEX_OUTPUT ${TELE[1]}; fi;
-    		if [ -z "${DLST}" ]; then
-    			echo $PNEX_OUTPUT;
-    		else
-    			if [ -z ${INDIV} ]; then
-    			FILEOUT="${DLST}/meshtastic.prom"
-    			else
-    			FILEOUT="${DLST}/meshtastic-${NODEFILE}.prom"
-    			fi
-    			echo $PNEX_OUTPUT >> ${FILEOUT}.$$; #Maybe into array and return, handle write somewhere else
-    		fi;
+			if [ "${VERB}" -eq 1 ]; then echo "Node Exporter formated: ${PNEX_OUTPUT}" ${TELE[1]}; fi;
+    		PNEX_BUF+=("${PNEX_OUTPUT}"); # Flushed per node or file by flush_prom
 
 	done
 }
 
+# Write the buffered node_exporter lines to file $1 (stdout when empty)
+# with one printf and empty the buffer. bash line-buffers its output, so
+# this is still one write(2) per line, not one per call.
+function flush_prom() {
+	if [ ${#PNEX_BUF[@]} -gt 0 ]; then
+		if [ -z "$1" ]; then
+			printf '%s\n' "${PNEX_BUF[@]}"
+		else
+			printf '%s\n' "${PNEX_BUF[@]}" > "$1"
+		fi
+	fi
+	PNEX_BUF=()
+}
+
 function ocsv() {
 	echo "Not developed yet."
 	exit 1
@@ -270,19 +302,34 @@ case $MODE in
 	     :) echo "Option -$OPTARG requires an argument." >&2;exit 1;;
 		\?) echo "Invalid option: -$OPTARG"; usage >&2;exit 1;;
 esac;
+
+case $FORMAT in
+	node_exporter) ;;
+	*) echo "Invalid option: -o $FORMAT"; usage >&2;exit 1;;
+esac;
+
+# Settings snapshot for the per-node path, resolved once instead of per request.
+MTCMD=( ${MESHTASTIC} ${METHOD} ${PORT} ${RTO:+--timeout ${RTO}} --request-telemetry --dest )
+readonly MTCMD MESHTASTIC METHOD PORT RTO FORMAT VERB PDT
 	
     count=0
-function invoke_telem() {
-  trap - INT
-  if [ -f "$DLST" ]; then
-  rm ${DLST}
-  fi
-  if [ ${?} -eq 0 ]; then while read L; do if [[ ${L} =~ ${R1} ]]; then
-	NODE="${BASH_REMATCH[1]}";
-	PROP="${BASH_REMATCH[2]}";
-	LOCA="${BASH_REMATCH[3]}";
-	LATI="${BASH_REMATCH[4]}";
-	LONG="${BASH_REMATCH[5]}";
+# Strip leading and trailing whitespace from the variable named $1.
+function trim() {
+	local v="${!1}"
+	v="${v#"${v%%[![:space:]]*}"}"
+	printf -v "$1" '%s' "${v%"${v##*[![:space:]]}"}"
+}
+
+# Poll device number $1 of the list parsed by load_devices.
+function poll_node() {
+	local i VAL KEYS VALS array
+	L="${DEVLINES[$1]}";
+	NODE="${NODES[$1]}";
+	NODEFILE="${NODEFILES[$1]}";
+	PROP="${PROPS[$1]}";
+	LOCA="${LOCAS[$1]}";
+	LATI="${LATIS[$1]}";
+	LONG="${LONGS[$1]}";
 
 	
 	if [ "${VERB}" -eq 1 ]; then
@@ -291,72 +338,178 @@ function invoke_telem() {
 	
 	if [ "${DOLS}" -eq 1 ]; then
 		echo "${NODE}";
-		continue;
+		return;
 	fi;
 
 	if [ "${DOLS}" -eq 2 ]; then
 		echo "${L}";
-		continue;
+		return;
 	fi;
-	NODEFILE=( $( echo $NODE | sed -e 's/\!//g' ) )
     array=()
 	IFS=$'\n'
-    array+=( $(${MESHTASTIC} $METHOD $PORT --request-telemetry --dest $NODE | grep -ahE "${GREPARGS}") );
+    array+=( $("${MTCMD[@]}" $NODE | grep -ahE "${GREPARGS}") );
     	if [ "${VERB}" -eq 1 ]; then
-    		echo "${MESHTASTIC} $METHOD $PORT --request-telemetry --dest $NODE"
+    		echo "${MTCMD[@]}" $NODE
     	fi
+	# Telemetry arrives as "Key: value" text and is split once here; the
+	# device list fields are already separate and go in as they are.
+	KEYS=(); VALS=()
+	for i in "${array[@]}"; do
+		KEYS+=("${i%%:*}")
+		VAL=${i#*:}; VAL=${VAL%%:*}; VAL=${VAL%[Vv%]}; trim VAL # value, minus its unit
+		VALS+=("${VAL}")
+	done
 	if [ ! -z "${array[2]}" ]; then
     	(( count++ ))
-    	if [ ! -z $PROP ]; then array+=("Contact: ${PROP}"); fi
-    	if [ ! -z $LOCA ]; then array+=("Location: ${LOCA}"); fi
-		if [ ! -z $LATI ]; then array+=("Latitude: ${LATI}"); fi
-		if [ ! -z $LONG ]; then array+=("Longitude: ${LONG}"); fi
-		array+=("up: ${VERSION}");
+		KEYS+=(up); VALS+=("${VERSION}");
 	else
-		array+=("up: 0")
+		KEYS+=(up); VALS+=(0)
 	fi
   
+    if [ "${VERB}" -eq 1 ]; then
     for i in ${array[@]}
     do 
-    	if [ "${VERB}" -eq 1 ]; then
     	echo $NODE " Raw variable:  " $i
-    	fi;
-
 	done
+    fi;
     	case $FORMAT in
 
-			  node_exporter) promnode "${array[@]}";;
-			        	*) echo "Invalid option: -c $FORMAT"; usage >&2;exit 1;;
+			  node_exporter) promnode
+			  	# Device list lines, formatted once by load_devices
+			  	if [ ! -z "${array[2]}" ] && [ ! -z "${INFOS[$1]}" ]; then
+			  		PNEX_BUF+=("${INFOS[$1]}");
+			  		if [ "${VERB}" -eq 1 ]; then echo "Node Exporter formated: ${INFOS[$1]}"; fi;
+			  	fi;;
 		esac;
 		
-if [ ! -z $INDIV ]; then
-if [ ! -z $DLST ]; then mv ${FILEOUT}.$$  ${FILEOUT}; fi
+if [ -z $DLST ]; then flush_prom; fi
+if [ ! -z $DLST ]; then
+if [ -z $INDIV ]; then
+	flush_prom >&5 # meshtastic.prom, opened once by invoke_telem
+else
+	FILEOUT="${DLST}/meshtastic-${NODEFILE}.prom"
+	flush_prom ${FILEOUT}.$$; mv -f ${FILEOUT}.$$ ${FILEOUT}
 fi
-		wait $PDT 2>/dev/null
-	
- 
+fi
+}
+
+# Print the device list without comments or blank lines. grep reads the
+# plain file itself, an encrypted list is decrypted first so a bad
+# password is caught by openssl's padding check. Returns 2 on failure.
+function read_devfile() {
+  if [ -z "${DEVFILEPASS}" ]; then
+  	grep -Ev "${DEVSKIP}" "${DEVFILE}";
   else
-	echo "ERROR: incorrect device string: "${L}"";
-	RS=1;
+  	# Binary openssl output starts with "Salted__", anything else is taken as base64 (-a).
+  	local magic b64=""
+  	LC_ALL=C read -r -n 8 magic < "${DEVFILE}"
+  	if [ "${magic}" != "Salted__" ]; then b64="-a"; fi
+  	local plain
+  	{ plain=$("${OPENSSL}" enc -in "${DEVFILE}" ${OPENSSL_OPT} -iter ${PBKDF2_ITER} -d ${b64} -pass pass:"${DEVFILEPASS}"); } 2>/dev/null
+  	if [ ${?} -ne 0 ]; then
+  		echo "ERROR: unable to decrypt ${DEVFILE}, check the password and iterations (-I)." >&2
+  		return 2
+  	fi
+  	grep -Ev "${DEVSKIP}" <<< "${plain}";
   fi;
-  
+}
 
- done < <((\
- IFS=$','
-  if [ -z "${DEVFILEPASS}" ]; then \
-  	cat "${DEVFILE}"; \
-  else \
-  	"${OPENSSL}" enc -in "${DEVFILE}" ${OPENSSL_OPT} -d -pass pass:"${DEVFILEPASS}"; \
-  fi;) | grep -Ev "^( +)?#.*$|^$" | sort -u | sort -t@ -n);
+# Read the device list and split every line into the DEVLINES, NODES,
+# NODEFILES (ID without "!"), PROPS, LOCAS, LATIS and LONGS arrays once,
+# before any polling starts.
+# Lines that do not parse are reported here and set RS.
+function load_devices() {
+  local DEVLIST INFO KEYS VALS
+  DEVLIST=$(read_devfile)
+  if [ ${?} -gt 1 ]; then return 1; fi
+  DEVLINES=(); NODES=(); NODEFILES=(); PROPS=(); LOCAS=(); LATIS=(); LONGS=(); INFOS=()
+  while read L; do
+	L="${L%$'\r'}" # Device files saved with CRLF line endings
+	if [ -z "${L}" ]; then continue; fi
+	if [[ ${L} =~ ${R1} ]]; then
+		DEVLINES+=("${L}");
+		NODES+=("${BASH_REMATCH[1]}");
+		NODEFILES+=("${BASH_REMATCH[1]//!/}");
+		PROP="${BASH_REMATCH[2]}"; trim PROP; PROPS+=("${PROP}");
+		LOCA="${BASH_REMATCH[3]}"; trim LOCA; LOCAS+=("${LOCA}");
+		LATI="${BASH_REMATCH[4]}"; LATIS+=("${LATI}");
+		LONG="${BASH_REMATCH[5]}"; LONGS+=("${LONG}");
+		# The device list fields never change during a run, so their
+		# metric lines are formatted here once for poll_node to reuse.
+		# -l/-L only list the devices and need none of them. promnode's -v
+		# echo is silenced here; poll_node shows the block when it is used.
+		if [ "${DOLS}" -eq 0 ]; then
+		NODE="${BASH_REMATCH[1]}"; KEYS=(); VALS=(); PNEX_BUF=()
+		if [ ! -z "${PROP}" ]; then KEYS+=(Contact); VALS+=("${PROP}"); fi
+		if [ ! -z "${LOCA}" ]; then KEYS+=(Location); VALS+=("${LOCA}"); fi
+		if [ ! -z "${LATI}" ]; then KEYS+=(Latitude); VALS+=("${LATI}"); fi
+		if [ ! -z "${LONG}" ]; then KEYS+=(Longitude); VALS+=("${LONG}"); fi
+		case $FORMAT in
+			node_exporter) promnode >/dev/null;;
+		esac;
+		printf -v INFO '%s\n' "${PNEX_BUF[@]}"; INFOS+=("${INFO%$'\n'}");
+		fi;
+	else
+		echo "ERROR: incorrect device string: "${L}"";
+		RS=1;
+	fi;
+  done < <(sort -u <<< "${DEVLIST}");
+}
 
+function invoke_telem() {
+  trap - INT
+  if [ -f "$DLST" ]; then
+  rm ${DLST}
+  fi
+  # Output directory and file name are settled once, not per node.
+  if [ ! -z "${DLST}" ]; then
+  FILEOUT="${DLST}/meshtastic.prom"
+  mkdir -p "${DLST}"
+  fi
+  if [ ${?} -eq 0 ]; then
+  # Decrypting (PBKDF2) happens here, inside the job the spinner is watching.
+  load_devices || return 1
+
+  PNEX_BUF=()
+  if [ "${DOLS}" -ne 0 ]; then
+	for (( d = 0; d < ${#NODES[@]}; d++ )); do poll_node ${d}; done
+	return ${RS}
+  fi;
+
+  # Open meshtastic.prom once in append mode; each node's lines are
+  # appended as they are polled.
+  if [ -z $INDIV ] && [ ! -z $DLST ]; then
+	: > ${FILEOUT}.$$
+	exec 5>> ${FILEOUT}.$$
+  fi
+
+  # Nodes are polled one at a time: the radio serves a single client over
+  # serial and over TCP, so concurrent polls would knock each other off.
+  local d
+  for (( d = 0; d < ${#NODES[@]}; d++ )); do
+	if [ ${d} -gt 0 ]; then sleep ${PDT}; fi
+	poll_node ${d}
+  done
+else
+  return 1
 fi;
 if [ -z $INDIV ]; then
-if [ ! -z $DLST ]; then mv ${FILEOUT}.$$  ${FILEOUT}; fi
+if [ ! -z $DLST ]; then
+	exec 5>&-
+	mv -f ${FILEOUT}.$$ ${FILEOUT}
 fi
+fi
+return ${RS}
 }
 
 
-
-if [ "${INTERACT}" -eq 0 ]; then invoke_telem; else invoke_telem & spinner $!; fi;
+if [ "${INTERACT}" -eq 0 ]; then
+	invoke_telem; RS=$?
+else
+	exec 4>&1
+	exec 3< <(invoke_telem >&4 4>&-; echo $?)
+	spinner >&2; RS=$?
+	exec 3<&- 4>&-
+fi;
 exit ${RS};
 